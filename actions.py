@@ -1,63 +1,149 @@
+import asyncio
+import functools
 import logging
-from typing import Dict, Text, Any, List, Union
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Text, Any, List, Union
 from rasa_sdk import Tracker
 from rasa_sdk.executor import CollectingDispatcher
 from rasa_sdk.forms import FormAction
 from rasa_sdk.events import AllSlotsReset
-import ruamel.yaml
+import yaml
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 vers = "vers: 0.1.0, date: Apr 2, 2020"
 logger.debug(vers)
 
-snow_config = ruamel.yaml.safe_load(open("snow_credentials.yml", "r")) or {}
+with open("snow_credentials.yml", "r") as f:
+    snow_config = yaml.load(f, Loader=SafeLoader) or {}
 snow_user = snow_config.get("snow_user")
 snow_pw = snow_config.get("snow_pw")
 snow_instance = snow_config.get("snow_instance")
 localmode = snow_config.get("localmode", True)
-logger.debug(f"Local mode: {localmode}")
+logger.debug("Local mode: %s", localmode)
 
 base_api_url = "https://{}/api/now".format(snow_instance)
+incident_url = f"{base_api_url}/table/incident"
+snow_headers = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+}
+
+# ServiceNow urgency codes for each supported priority
+priority_map = {"low": "3", "medium": "2", "high": "1"}
+supported_priorities = frozenset(priority_map)
+
+# Shared session so repeated ServiceNow calls reuse keep-alive connections.
+# Connect failures are retried for every method, which is safe for the
+# incident POST as well; read and gateway-error retries only apply to the
+# idempotent lookup (urllib3's default method whitelist excludes POST).
+snow_session = requests.Session()
+snow_session.auth = (snow_user, snow_pw)
+snow_session.headers.update(snow_headers)
+snow_session.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=20,
+        max_retries=Retry(
+            total=2,
+            connect=2,
+            read=1,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            raise_on_status=False,
+        ),
+    ),
+)
+# (connect, read) timeouts in seconds
+snow_timeout = (3.05, 10)
+
+# ServiceNow user lookups that found the user are reused for this many seconds
+email_cache_ttl = 300
+email_cache_size = 256
+email_cache = OrderedDict()
+
+
+async def email_to_sysid(email):
+    """Look up a ServiceNow user by email, reusing recent results."""
+    key = (email, int(time.time() // email_cache_ttl))
+    if key in email_cache:
+        email_cache.move_to_end(key)
+        return email_cache[key]
+    results = await _email_to_sysid(email)
+    # only cache a found user; errors and unknown emails (which an admin may
+    # be adding right now) should ask ServiceNow again on the next attempt
+    if results["status"] == 200 and len(results["value"]) == 1:
+        email_cache[key] = results
+        if len(email_cache) > email_cache_size:
+            email_cache.popitem(last=False)
+    return results
+
 
+def forget_email(email):
+    """Drop cached lookups for email, e.g. after ServiceNow rejected it."""
+    for key in [key for key in email_cache if key[0] == email]:
+        del email_cache[key]
 
-def email_to_sysid(email):
+
+def snow_error_message(response):
+    """Error message for a failed ServiceNow response.
+
+    Gateways in front of ServiceNow return HTML for 502/503/504, so fall
+    back to the status line when the body isn't a ServiceNow JSON error.
+    """
+    try:
+        return "ServiceNow error: " + response.json()["error"]["message"]
+    except (ValueError, KeyError, TypeError):
+        return f"ServiceNow error: {response.status_code} {response.reason}"
+
+
+async def snow_request(method, url, **kwargs):
+    """Send a snow_session request from a worker thread.
+
+    requests is blocking, so running it in the default executor keeps the
+    action server's event loop free while ServiceNow responds.
+    """
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(
+        None,
+        functools.partial(
+            snow_session.request, method, url, timeout=snow_timeout, **kwargs
+        ),
+    )
+
+
+async def _email_to_sysid(email):
     lookup_url = f"{base_api_url}/table/sys_user?sysparm_limit=1&email={email}"
-    user = snow_user
-    pwd = snow_pw
-    # Set proper headers
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }  # noqa: 501
     results = dict()
     results["status"] = 200
     # Do the HTTP request
     try:
-        response = requests.get(lookup_url, auth=(user, pwd), headers=headers)
+        response = await snow_request("GET", lookup_url)
         if response.status_code == 200:
             results["value"] = response.json()["result"]
         else:
             results["status"] = response.status_code
-            results["msg"] = (
-                "ServiceNow error: " + response.json()["error"]["message"]
-            )
+            results["msg"] = snow_error_message(response)
     except requests.exceptions.Timeout:
+        results["status"] = 408
         results["msg"] = "Could not connect to ServiceNow (Timeout)"
+    except requests.exceptions.ConnectionError:
+        results["status"] = 503
+        results["msg"] = "Could not connect to ServiceNow"
     return results
 
 
-def create_incident(description, short_description, priority, caller):
-    incident_url = "https://{}/api/now/table/incident".format(snow_instance)
-    user = snow_user
-    pwd = snow_pw
-    # Set proper headers
-    headers = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-    }  # noqa: 501
+async def create_incident(description, short_description, priority, caller):
     data = {
         "opened_by": caller,
         "short_description": short_description,
@@ -66,13 +152,13 @@ def create_incident(description, short_description, priority, caller):
         "caller_id": caller,
         "comments": description,
     }
-    response = requests.post(
-        incident_url, auth=(user, pwd), headers=headers, data=json.dumps(data)
-    )
+    response = await snow_request("POST", incident_url, json=data)
     return response
 
 
 class OpenIncidentForm(FormAction):
+    _slot_mappings = None
+
     def name(self) -> Text:
         return "open_incident_form"
 
@@ -89,34 +175,38 @@ class OpenIncidentForm(FormAction):
             - a whole message
             or a list of them, where a first match will be picked"""
 
-        return {
-            "email": self.from_entity(entity="email"),
-            "priority": self.from_entity(entity="priority"),
-            "problem_description": [
-                self.from_text(
-                    intent=["password_reset", "problem_email", "inform"]
-                )
-            ],
-            "incident_title": [
-                self.from_trigger_intent(
-                    intent="password_reset", value="Problem resetting password"
-                ),
-                self.from_trigger_intent(
-                    intent="problem_email", value="Problem with email"
-                ),
-                self.from_text(
-                    intent=["password_reset", "problem_email", "inform"]
-                ),
-            ],
-        }
+        # the mappings don't depend on the tracker, so build them only once
+        if self._slot_mappings is None:
+            self._slot_mappings = {
+                "email": self.from_entity(entity="email"),
+                "priority": self.from_entity(entity="priority"),
+                "problem_description": [
+                    self.from_text(
+                        intent=["password_reset", "problem_email", "inform"]
+                    )
+                ],
+                "incident_title": [
+                    self.from_trigger_intent(
+                        intent="password_reset",
+                        value="Problem resetting password",
+                    ),
+                    self.from_trigger_intent(
+                        intent="problem_email", value="Problem with email"
+                    ),
+                    self.from_text(
+                        intent=["password_reset", "problem_email", "inform"]
+                    ),
+                ],
+            }
+        return self._slot_mappings
 
     @staticmethod
-    def priority_db() -> List[Text]:
+    def priority_db() -> FrozenSet[Text]:
         """Database of supported priorities"""
 
-        return ["low", "medium", "high"]
+        return supported_priorities
 
-    def validate_email(
+    async def validate_email(
         self,
         value: Text,
         dispatcher: CollectingDispatcher,
@@ -126,20 +216,23 @@ class OpenIncidentForm(FormAction):
         """Validate email is in ticket system."""
         if localmode:
             return {"email": value}
-        results = email_to_sysid(value)
+        results = await email_to_sysid(value)
 
         if results["status"] == 200:
             # validation succeeded, set the value of the "email" slot to value
             if len(results["value"]) == 1:
-                return {"email": value}
+                return {
+                    "email": value,
+                    "caller_sysid": results["value"][0]["sys_id"],
+                }
             else:
                 dispatcher.utter_message(template="utter_no_email")
-                return {"email": None}
+                return {"email": None, "caller_sysid": None}
         else:
             dispatcher.utter_message(results["msg"])
             # validation failed, set this slot to None, meaning the
             # user will be asked for the slot again
-            return {"email": None}
+            return {"email": None, "caller_sysid": None}
 
     def validate_priority(
         self,
@@ -160,7 +253,7 @@ class OpenIncidentForm(FormAction):
             # user will be asked for the slot again
             return {"priority": None}
 
-    def submit(
+    async def submit(
         self,
         dispatcher: CollectingDispatcher,
         tracker: Tracker,
@@ -174,13 +267,7 @@ class OpenIncidentForm(FormAction):
         problem_description = tracker.get_slot("problem_description")
         incident_title = tracker.get_slot("incident_title")
 
-        # Check priority and set number value accordingly
-        if priority == "low":
-            snow_priority = "3"
-        elif priority == "medium":
-            snow_priority = "2"
-        else:
-            snow_priority = "1"
+        snow_priority = priority_map.get(priority.lower(), "1")
 
         if localmode:
             message = (
@@ -191,19 +278,47 @@ class OpenIncidentForm(FormAction):
                 f"title: {incident_title}\npriority: {priority}"
             )
         else:
-            results = email_to_sysid(email)
-            sysid = results["value"][0]["sys_id"]
-            response = create_incident(
-                description=problem_description,
-                short_description=incident_title,
-                priority=snow_priority,
-                caller=sysid,
-            )
-            incident_number = response.json()["result"]["number"]
-            message = (
-                f"Successfully opened up incident {incident_number} for you.  "
-                f"Someone will reach out soon."
-            )
+            sysid = tracker.get_slot("caller_sysid")
+            if not sysid:
+                results = await email_to_sysid(email)
+                if results["status"] != 200:
+                    dispatcher.utter_message(results["msg"])
+                    return [AllSlotsReset()]
+                if len(results["value"]) != 1:
+                    dispatcher.utter_message(template="utter_no_email")
+                    return [AllSlotsReset()]
+                sysid = results["value"][0]["sys_id"]
+            try:
+                response = await create_incident(
+                    description=problem_description,
+                    short_description=incident_title,
+                    priority=snow_priority,
+                    caller=sysid,
+                )
+            except requests.exceptions.ReadTimeout:
+                # the request was sent, so the incident may exist already
+                dispatcher.utter_message(
+                    "ServiceNow did not respond in time (Timeout). "
+                    "The incident may have been created, please check "
+                    "before submitting it again."
+                )
+                return [AllSlotsReset()]
+            except requests.exceptions.RequestException:
+                dispatcher.utter_message("Could not connect to ServiceNow")
+                return [AllSlotsReset()]
+            if response.status_code == 201:
+                incident_number = response.json()["result"]["number"]
+                message = (
+                    f"Successfully opened up incident {incident_number} "
+                    f"for you.  Someone will reach out soon."
+                )
+            else:
+                message = snow_error_message(response)
+                # the cached caller may be stale, so look it up fresh next
+                # time; auth and rate limit errors say nothing about it
+                status = response.status_code
+                if 400 <= status < 500 and status not in (401, 403, 429):
+                    forget_email(email)
             # utter submit template
         dispatcher.utter_message(message)
         return [AllSlotsReset()]